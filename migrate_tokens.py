@@ -14,36 +14,364 @@ Usage:
     # Migrate only users:
     python migrate_tokens.py --sqlite-file oneapi.db --users-only --db-host localhost --db-port 5432 --db-name newapi --db-user postgres --db-password your_password
 
+    # Fan out to several New API shards in one read pass:
+    python migrate_tokens.py --sqlite-file oneapi.db --db-user postgres --db-password your_password --shard db1:5432/newapi --shard db2:5432/newapi
+
+    # Profile each stage (pstats files and report are written next to the backup file):
+    python migrate_tokens.py --sqlite-file oneapi.db --db-name newapi --db-user postgres --db-password your_password --profile
+
+    # Migrate and warm up New API's Redis token cache afterwards:
+    python migrate_tokens.py --sqlite-file oneapi.db --db-name newapi --db-user postgres --db-password your_password --warm-cache --redis-url redis://localhost:6379/0 --crypto-secret your_crypto_secret
+
+    # Compressed dumps and tarballs are read directly (streamed, or extracted once for SQLite):
+    python migrate_tokens.py --sql-file oneapi.sql.zst --db-name newapi --db-user postgres --db-password your_password
+    python migrate_tokens.py --sqlite-file oneapi-backup.tar.gz --db-name newapi --db-user postgres --db-password your_password
+
+    # Migrate into a MySQL or SQLite New API database:
+    python migrate_tokens.py --sqlite-file oneapi.db --db-type mysql --db-host localhost --db-name newapi --db-user root --db-password your_password
+    python migrate_tokens.py --sqlite-file oneapi.db --db-type sqlite --db-name one-api.db
+
 Requirements:
-    pip install psycopg2-binary sqlparse
+    pip install sqlparse
+    pip install psycopg2-binary  # PostgreSQL target
+    pip install pymysql  # MySQL target
+    pip install redis  # only needed for --warm-cache
+    pip install zstandard  # only needed for .zst sources when the zstd/pzstd command is not installed
 """
 
+import abc
 import argparse
+import bz2
+import contextlib
+import cProfile
+import gzip
+import hashlib
+import hmac
+import io
 import json
+import lzma
 import os
+import pstats
+import queue
 import re
+import shutil
 import sqlite3
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Optional, Any
 
 try:
-    import psycopg2
-    import psycopg2.extras
     import sqlparse
 except ImportError:
-    print("Please install required packages: pip install psycopg2-binary sqlparse")
+    print("Please install required packages: pip install sqlparse")
     sys.exit(1)
 
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None  # 仅 PostgreSQL 目标需要
+
+try:
+    import pymysql
+except ImportError:
+    pymysql = None  # 仅 MySQL 目标需要
+
+try:
+    import redis
+except ImportError:
+    redis = None  # 仅 --warm-cache 需要
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # 仅在没有zstd命令时解压 .zst 源文件需要
+
+
+# 与 New API model/token_cache.go 中 cacheInitToken 使用的脚本保持一致：
+# fence 存在时不写入，哈希已存在时只刷新 TTL，绝不覆盖线上的 RemainQuota。
+# 返回值：0=被 fence 拦截，1=完成初始化，2=哈希已存在，仅刷新 TTL。
+TOKEN_CACHE_INIT_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+  return 0
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('EXPIRE', KEYS[1], ARGV[17])
+  return 2
+end
+redis.call('HSET', KEYS[1],
+  'Id', ARGV[1], 'UserId', ARGV[2], 'Status', ARGV[3], 'Name', ARGV[4],
+  'CreatedTime', ARGV[5], 'AccessedTime', ARGV[6], 'ExpiredTime', ARGV[7],
+  'UnlimitedQuota', ARGV[8], 'ModelLimitsEnabled', ARGV[9], 'ModelLimits', ARGV[10],
+  'AllowIps', ARGV[11], 'Group', ARGV[12], 'CrossGroupRetry', ARGV[13],
+  'AutoGroups', ARGV[14], 'RemainQuota', ARGV[15], 'UsedQuota', ARGV[16])
+redis.call('EXPIRE', KEYS[1], ARGV[17])
+return 1"""
+
+
+def format_go_bool(val: Any) -> str:
+    """按Go strconv.FormatBool的格式输出布尔值"""
+    return 'true' if val else 'false'
+
+
+# 源文件压缩格式的魔数，按内容而不是扩展名识别
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+)
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.zst', '.tzst', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+SQL_SUFFIXES = ('.sql',)
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """根据文件头识别压缩格式，未压缩返回None"""
+    with open(path, 'rb') as f:
+        header = f.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if header.startswith(magic):
+            return compression
+    return None
+
+
+def is_tar_archive(path: str) -> bool:
+    return path.lower().endswith(TAR_SUFFIXES)
+
+
+@contextlib.contextmanager
+def open_decompressed(path: str):
+    """以二进制流打开源文件，压缩文件边读边解压，不落盘"""
+    compression = detect_compression(path)
+    if compression is None:
+        with open(path, 'rb') as f:
+            yield f
+    elif compression == 'gzip':
+        with gzip.open(path, 'rb') as f:
+            yield f
+    elif compression == 'bz2':
+        with bz2.open(path, 'rb') as f:
+            yield f
+    elif compression == 'xz':
+        with lzma.open(path, 'rb') as f:
+            yield f
+    else:
+        # zstd优先用独立进程解压（pzstd可多线程），与解析并行；否则退回zstandard模块
+        pzstd = shutil.which('pzstd')
+        zstd = shutil.which('zstd')
+        if pzstd or zstd:
+            cmd = ([pzstd, '-d', '-c', '-p', str(os.cpu_count() or 1), path] if pzstd
+                   else [zstd, '-d', '-c', path])
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    bufsize=STREAM_CHUNK_SIZE)
+            exhausted = False
+            try:
+                yield proc.stdout
+                exhausted = not proc.stdout.closed and not proc.stdout.read(1)
+            finally:
+                # 调用方提前结束读取（如只需要tar中的一个成员）时直接结束解压进程
+                proc.stdout.close()
+                if not exhausted:
+                    proc.kill()
+                stderr = proc.stderr.read().decode('utf-8', errors='replace')
+                proc.stderr.close()
+                returncode = proc.wait()
+            if exhausted and returncode != 0:
+                raise RuntimeError(f"{os.path.basename(cmd[0])} failed: {stderr.strip()}")
+        elif zstandard is not None:
+            with open(path, 'rb') as raw:
+                with zstandard.ZstdDecompressor().stream_reader(raw, read_size=STREAM_CHUNK_SIZE) as f:
+                    yield f
+        else:
+            raise RuntimeError("zstd input requires the zstd/pzstd command or: pip install zstandard")
+
+
+@contextlib.contextmanager
+def open_source_stream(path: str, suffixes):
+    """打开源文件；tar包（可压缩）中按扩展名选取第一个匹配的成员并流式读取"""
+    with open_decompressed(path) as stream:
+        if not is_tar_archive(path):
+            yield stream
+            return
+        with tarfile.open(fileobj=stream, mode='r|') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(suffixes):
+                    print(f"Using archive member: {member.name}")
+                    yield archive.extractfile(member)
+                    return
+        raise RuntimeError(f"No {'/'.join(suffixes)} file found in archive {path}")
+
+
+# New API 目标表写入的列，顺序即批量写入时的行元组顺序
+USER_COLUMNS = (
+    'username', 'password', 'display_name', 'role', 'status', 'email',
+    'github_id', 'oidc_id', 'wechat_id', 'telegram_id', 'access_token',
+    'quota', 'used_quota', 'request_count', 'group', 'aff_code', 'aff_count',
+)
+TOKEN_COLUMNS = (
+    'user_id', 'key', 'status', 'name', 'created_time', 'accessed_time',
+    'expired_time', 'remain_quota', 'unlimited_quota', 'model_limits_enabled',
+    'model_limits', 'allow_ips', 'used_quota', 'group',
+)
+
+
+def format_tsv_value(val: Any) -> str:
+    """按PostgreSQL COPY / MySQL LOAD DATA的文本格式转义单个值"""
+    if val is None:
+        return '\\N'
+    if isinstance(val, bool):
+        return '1' if val else '0'
+    return (str(val).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+class TargetBackend(abc.ABC):
+    """New API目标数据库后端基类，子类实现各自的连接、批量写入和备份方式"""
+    placeholder = '%s'
+    backup_suffix = '.sql'
+    commit_per_batch = True
 
-class TokenMigrator:
     def __init__(self, db_config: Dict[str, Any]):
         self.db_config = db_config
         self.conn = None
-        
-    def connect_db(self):
+
+    def describe(self) -> str:
+        return f"{self.db_config['host']}:{self.db_config['port']}/{self.db_config['database']}"
+
+    @abc.abstractmethod
+    def connect(self):
+        pass
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+
+    @abc.abstractmethod
+    def backup(self, backup_path: str) -> Optional[str]:
+        pass
+
+    @abc.abstractmethod
+    def restore_hint(self, backup_file: str) -> str:
+        pass
+
+    def quote(self, name: str) -> str:
+        return f'"{name}"'
+
+    def column_list(self, columns) -> str:
+        return ', '.join(self.quote(c) for c in columns)
+
+    def insert_sql(self, table: str, columns) -> str:
+        placeholders = ', '.join([self.placeholder] * len(columns))
+        return f"INSERT INTO {table} ({self.column_list(columns)}) VALUES ({placeholders})"
+
+    def execute(self, sql: str, params=()):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+        finally:
+            cursor.close()
+
+    def fetch_column(self, sql: str) -> set:
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql)
+            return {row[0] for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    def fetch_dicts(self, sql: str, params=()) -> List[Dict]:
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(sql, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def existing_usernames(self) -> set:
+        return self.fetch_column(f"SELECT {self.quote('username')} FROM users")
+
+    def existing_token_keys(self) -> set:
+        return self.fetch_column(f"SELECT {self.quote('key')} FROM tokens WHERE deleted_at IS NULL")
+
+    def fetch_user_ids(self, usernames: List[str]) -> Dict[str, int]:
+        """按用户名读取New API中的用户id"""
+        placeholders = ', '.join([self.placeholder] * len(usernames))
+        rows = self.fetch_dicts(
+            f"SELECT {self.quote('id')}, {self.quote('username')} FROM users "
+            f"WHERE {self.quote('username')} IN ({placeholders})",
+            tuple(usernames)
+        )
+        return {row['username']: row['id'] for row in rows}
+
+    def count_orphan_tokens(self, keys: List[str]) -> int:
+        """统计给定token中user_id在users表里不存在的数量"""
+        placeholders = ', '.join([self.placeholder] * len(keys))
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM tokens t LEFT JOIN users u ON u.{self.quote('id')} = t.{self.quote('user_id')} "
+                f"WHERE u.{self.quote('id')} IS NULL AND t.{self.quote('key')} IN ({placeholders}) "
+                f"AND t.deleted_at IS NULL",
+                tuple(keys)
+            )
+            return cursor.fetchone()[0]
+        finally:
+            cursor.close()
+
+    def fetch_tokens(self, keys: List[str]) -> List[Dict]:
+        """按key读取tokens（包含数据库生成的id）"""
+        columns = ('id',) + TOKEN_COLUMNS
+        placeholders = ', '.join([self.placeholder] * len(keys))
+        return self.fetch_dicts(
+            f"SELECT {self.column_list(columns)} FROM tokens "
+            f"WHERE {self.quote('key')} IN ({placeholders}) AND deleted_at IS NULL",
+            tuple(keys)
+        )
+
+    def savepoint(self, name: str):
+        self.execute(f"SAVEPOINT {name}")
+
+    def release_savepoint(self, name: str):
+        self.execute(f"RELEASE SAVEPOINT {name}")
+
+    def rollback_to_savepoint(self, name: str):
+        self.execute(f"ROLLBACK TO SAVEPOINT {name}")
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def insert_row(self, table: str, columns, row: tuple):
+        self.execute(self.insert_sql(table, columns), row)
+
+    def bulk_insert(self, table: str, columns, rows: List[tuple]):
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany(self.insert_sql(table, columns), rows)
+        finally:
+            cursor.close()
+
+
+class PostgresBackend(TargetBackend):
+    """PostgreSQL目标：COPY FROM STDIN批量写入"""
+
+    def connect(self):
         """连接PostgreSQL数据库"""
+        if psycopg2 is None:
+            print("Please install required packages: pip install psycopg2-binary")
+            sys.exit(1)
         try:
             self.conn = psycopg2.connect(
                 host=self.db_config['host'],
@@ -56,20 +384,24 @@ class TokenMigrator:
         except Exception as e:
             print(f"Failed to connect to database: {e}")
             sys.exit(1)
-    
-    def close_db(self):
-        """关闭数据库连接"""
-        if self.conn:
-            self.conn.close()
-    
-    def backup_database(self, backup_path: Optional[str] = None) -> str:
+
+    def bulk_insert(self, table: str, columns, rows: List[tuple]):
+        buf = io.StringIO()
+        for row in rows:
+            buf.write('\t'.join(format_tsv_value(v) for v in row))
+            buf.write('\n')
+        buf.seek(0)
+        cursor = self.conn.cursor()
+        try:
+            cursor.copy_expert(f"COPY {table} ({self.column_list(columns)}) FROM STDIN", buf)
+        finally:
+            cursor.close()
+
+    def restore_hint(self, backup_file: str) -> str:
+        return f"psql -h host -U user -d database -f {backup_file}"
+
+    def backup(self, backup_path: str) -> Optional[str]:
         """备份PostgreSQL数据库"""
-        if not backup_path:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_path = f"newapi_backup_{timestamp}.sql"
-        
-        print(f"Creating database backup: {backup_path}")
-        
         try:
             # 使用pg_dump进行备份
             cmd = [
@@ -99,12 +431,12 @@ class TokenMigrator:
         except FileNotFoundError:
             print("pg_dump not found. Please install PostgreSQL client tools.")
             print("Attempting alternative backup method...")
-            return self.backup_database_alternative(backup_path)
+            return self.backup_alternative(backup_path)
         except Exception as e:
             print(f"Backup failed: {e}")
             return None
     
-    def backup_database_alternative(self, backup_path: str) -> Optional[str]:
+    def backup_alternative(self, backup_path: str) -> Optional[str]:
         """使用Python备份tokens表数据"""
         try:
             cursor = self.conn.cursor()
@@ -181,14 +513,334 @@ class TokenMigrator:
         except Exception as e:
             print(f"Alternative backup failed: {e}")
             return None
+
+
+class MySQLBackend(TargetBackend):
+    """MySQL目标：LOAD DATA LOCAL INFILE，或executemany合并的多行INSERT"""
+
+    def __init__(self, db_config: Dict[str, Any]):
+        super().__init__(db_config)
+        self.load_data = db_config.get('mysql_load_data', False)
+
+    def quote(self, name: str) -> str:
+        return f"`{name}`"
+
+    def connect(self):
+        """连接MySQL数据库"""
+        if pymysql is None:
+            print("Please install required packages: pip install pymysql")
+            sys.exit(1)
+        try:
+            self.conn = pymysql.connect(
+                host=self.db_config['host'],
+                port=self.db_config['port'],
+                database=self.db_config['database'],
+                user=self.db_config['user'],
+                password=self.db_config['password'],
+                charset='utf8mb4',
+                local_infile=self.load_data
+            )
+            print(f"Successfully connected to MySQL database: {self.db_config['database']}")
+        except Exception as e:
+            print(f"Failed to connect to database: {e}")
+            sys.exit(1)
+
+    def bulk_insert(self, table: str, columns, rows: List[tuple]):
+        cursor = self.conn.cursor()
+        try:
+            if not self.load_data:
+                # pymysql会把INSERT ... VALUES的executemany改写为多行INSERT
+                cursor.executemany(self.insert_sql(table, columns), rows)
+            else:
+                with tempfile.NamedTemporaryFile('w', suffix='.tsv', encoding='utf-8', delete=False) as f:
+                    for row in rows:
+                        f.write('\t'.join(format_tsv_value(v) for v in row))
+                        f.write('\n')
+                try:
+                    cursor.execute(
+                        f"LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8mb4 "
+                        f"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+                        f"({self.column_list(columns)})",
+                        (f.name,)
+                    )
+                finally:
+                    os.unlink(f.name)
+            # LOCAL模式下重复键只产生警告，行数不符时交给调用方逐行重试
+            if cursor.rowcount != len(rows):
+                raise RuntimeError(f"expected {len(rows)} rows, loaded {cursor.rowcount}")
+        finally:
+            cursor.close()
+
+    def restore_hint(self, backup_file: str) -> str:
+        return f"mysql -h host -u user -p database < {backup_file}"
+
+    def backup(self, backup_path: str) -> Optional[str]:
+        """使用mysqldump备份MySQL数据库"""
+        try:
+            cmd = [
+                'mysqldump',
+                '-h', str(self.db_config['host']),
+                '-P', str(self.db_config['port']),
+                '-u', self.db_config['user'],
+                '--single-transaction',
+                f"--result-file={backup_path}",
+                self.db_config['database']
+            ]
+            env = os.environ.copy()
+            env['MYSQL_PWD'] = self.db_config['password']
+
+            result = subprocess.run(cmd, env=env, capture_output=True, text=True)
+
+            if result.returncode == 0:
+                print(f"Database backup completed successfully: {backup_path}")
+                return backup_path
+            else:
+                print(f"Backup failed: {result.stderr}")
+                return None
+
+        except FileNotFoundError:
+            print("mysqldump not found. Please install MySQL client tools.")
+            return None
+        except Exception as e:
+            print(f"Backup failed: {e}")
+            return None
+
+
+class SQLiteBackend(TargetBackend):
+    """SQLite目标：WAL模式下单个事务内executemany，写入期间synchronous=OFF"""
+    placeholder = '?'
+    backup_suffix = '.db'
+    commit_per_batch = False
+
+    def describe(self) -> str:
+        return self.db_config['database']
+
+    def savepoint(self, name: str):
+        # 外层显式BEGIN，避免最外层RELEASE SAVEPOINT直接提交，保证整个写入在一个事务内
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        super().savepoint(name)
+
+    def connect(self):
+        """连接SQLite数据库，写入前切换到WAL并关闭同步"""
+        try:
+            # 分片迁移时由写入线程使用该连接，同一时刻只有一个线程访问
+            self.conn = sqlite3.connect(self.db_config['database'], check_same_thread=False)
+            self.journal_mode = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+            self.synchronous = self.conn.execute("PRAGMA synchronous").fetchone()[0]
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=OFF")
+            print(f"Successfully connected to SQLite database: {self.db_config['database']}")
+        except Exception as e:
+            print(f"Failed to connect to database: {e}")
+            sys.exit(1)
+
+    def close(self):
+        """恢复连接前的同步与日志模式"""
+        if self.conn:
+            try:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                self.conn.execute(f"PRAGMA synchronous={self.synchronous}")
+                # New API仍打开该文件时无法退出WAL，只提示不中断收尾
+                self.conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+            except Exception as e:
+                print(f"Warning: Could not restore SQLite pragmas on {self.db_config['database']}: {e}")
+            finally:
+                self.conn.close()
+
+    def restore_hint(self, backup_file: str) -> str:
+        return f"cp {backup_file} {self.db_config['database']}"
+
+    def backup(self, backup_path: str) -> Optional[str]:
+        """使用SQLite在线备份API复制数据库文件"""
+        try:
+            backup_conn = sqlite3.connect(backup_path)
+            try:
+                self.conn.backup(backup_conn)
+            finally:
+                backup_conn.close()
+            print(f"Database backup completed successfully: {backup_path}")
+            return backup_path
+        except Exception as e:
+            print(f"Backup failed: {e}")
+            return None
+
+
+TARGET_BACKENDS = {
+    'postgres': PostgresBackend,
+    'mysql': MySQLBackend,
+    'sqlite': SQLiteBackend,
+}
+DEFAULT_DB_PORTS = {
+    'postgres': 5432,
+    'mysql': 3306,
+}
+
+
+# Python 3.12起cProfile基于sys.monitoring，每个进程只能有一个活动的profiler；
+# 更早的版本每个线程可以各自启用一个
+PER_THREAD_PROFILING = sys.version_info < (3, 12)
+
+
+class StageProfiler:
+    """按迁移阶段采集cProfile统计与tracemalloc快照，结束后写出pstats文件和汇总报告
+
+    tracemalloc的峰值和快照是进程级的，同一时刻只有一个阶段测量内存；Python 3.12+同一
+    时刻也只有一个阶段启用cProfile。无法采集的部分自动降级为只记录耗时。
+    """
+
+    def __init__(self, output_dir: str, top_n: int = 20):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.prefix = os.path.join(output_dir, f"migration_profile_{timestamp}")
+        self.top_n = top_n
+        self.stages = []
+        self.lock = threading.Lock()
+        self.profiling = 0
+        self.measuring = False
+        # 排除采集工具自身的分配
+        self.filters = [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+        ]
+        tracemalloc.start(10)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, profile: bool = True, memory: bool = True):
+        """采集一个阶段；profile控制cProfile，memory控制tracemalloc测量"""
+        with self.lock:
+            profile = profile and (PER_THREAD_PROFILING or not self.profiling)
+            memory = memory and not self.measuring
+            if profile:
+                self.profiling += 1
+            if memory:
+                self.measuring = True
+
+        record = {'name': name}
+        profiler = cProfile.Profile() if profile else None
+        if memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot().filter_traces(self.filters)
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            record['elapsed'] = time.perf_counter() - start
+            if memory:
+                _, record['peak'] = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot().filter_traces(self.filters)
+                record['allocations'] = after.compare_to(before, 'lineno')[:self.top_n]
+            if profiler:
+                record['stats_path'] = f"{self.prefix}_{name}.pstats"
+                profiler.dump_stats(record['stats_path'])
+            with self.lock:
+                if profile:
+                    self.profiling -= 1
+                if memory:
+                    self.measuring = False
+                self.stages.append(record)
+
+    def write_report(self) -> str:
+        """写出各阶段耗时、热点函数和内存分配Top-N报告"""
+        tracemalloc.stop()
+        report_path = f"{self.prefix}_report.txt"
+        with open(report_path, 'w', encoding='utf-8') as f:
+            f.write(f"Migration profile report ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')})\n\n")
+            f.write("Memory figures are process-wide (all threads) tracemalloc measurements and are only\n")
+            f.write("taken for stages that did not overlap another memory-measured stage.\n\n")
+            f.write("Stage summary:\n")
+            for stage in self.stages:
+                details = []
+                if 'stats_path' in stage:
+                    details.append("cProfile")
+                if 'peak' in stage:
+                    details.append(f"peak {stage['peak'] / 1024 / 1024:.1f} MiB")
+                f.write(f"  {stage['name']:<24} {stage['elapsed']:>10.3f}s  {', '.join(details) or 'timing only'}\n")
+            for stage in self.stages:
+                if 'stats_path' not in stage and 'peak' not in stage:
+                    continue
+                f.write(f"\n=== {stage['name']} ({stage['elapsed']:.3f}s) ===\n")
+                if 'stats_path' in stage:
+                    f.write(f"pstats: {stage['stats_path']}\n\n")
+                    f.write(f"Top {self.top_n} functions by cumulative time:\n")
+                    pstats.Stats(stage['stats_path'], stream=f).sort_stats('cumulative').print_stats(self.top_n)
+                if 'peak' in stage:
+                    f.write(f"Top {self.top_n} allocations by size delta:\n")
+                    for diff in stage['allocations']:
+                        f.write(f"  {diff}\n")
+        print(f"Profile report written: {report_path}")
+        return report_path
+
+
+class TokenMigrator:
+    def __init__(self, db_config: Dict[str, Any], cache_config: Optional[Dict[str, Any]] = None,
+                 batch_size: int = 1000):
+        self.db_config = db_config
+        self.cache_config = cache_config
+        self.backend = TARGET_BACKENDS[db_config.get('type', 'postgres')](db_config)
+        self.batch_size = batch_size
+        self.migrated_token_keys = []
+        # One API用户id -> New API用户id；None表示本次未迁移用户，token保留原user_id
+        self.user_id_map = None
+        self.profiler = None
+        self.source_paths = {}
+        self.source_temp_dir = None
+    
+    def stage(self, name: str, profile: bool = True, memory: bool = True):
+        """启用--profile时按阶段采集性能数据，否则不做任何事"""
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.stage(name, profile, memory)
+        
+    def connect_db(self):
+        """连接New API数据库"""
+        self.backend.connect()
+    
+    def close_db(self):
+        """关闭数据库连接"""
+        self.backend.close()
+    
+    def backup_database(self, backup_path: Optional[str] = None) -> Optional[str]:
+        """备份New API数据库"""
+        if not backup_path:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            backup_path = f"newapi_backup_{timestamp}{self.backend.backup_suffix}"
+        
+        print(f"Creating database backup: {backup_path}")
+        return self.backend.backup(backup_path)
+    
+    def resolve_sqlite_source(self, sqlite_file: str) -> str:
+        """返回可直接打开的SQLite路径；压缩或打包的源文件只解压到临时目录一次"""
+        if detect_compression(sqlite_file) is None and not is_tar_archive(sqlite_file):
+            return sqlite_file
+        if sqlite_file not in self.source_paths:
+            if self.source_temp_dir is None:
+                self.source_temp_dir = tempfile.mkdtemp(prefix='oneapi_source_')
+            target = os.path.join(self.source_temp_dir, f"source_{len(self.source_paths)}.db")
+            print(f"Extracting SQLite source {sqlite_file} to {target}")
+            with open_source_stream(sqlite_file, SQLITE_SUFFIXES) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+            self.source_paths[sqlite_file] = target
+        return self.source_paths[sqlite_file]
+    
+    def cleanup_sources(self):
+        """删除解压出的临时源文件"""
+        if self.source_temp_dir:
+            shutil.rmtree(self.source_temp_dir, ignore_errors=True)
+            self.source_temp_dir = None
+            self.source_paths = {}
     
     def parse_sql_file(self, sql_file: str) -> List[Dict]:
         """解析One API的SQL导出文件，提取tokens表数据"""
         print(f"Parsing SQL file: {sql_file}")
         
         try:
-            with open(sql_file, 'r', encoding='utf-8') as f:
-                sql_content = f.read()
+            with open_source_stream(sql_file, SQL_SUFFIXES) as f:
+                sql_content = f.read().decode('utf-8')
         except Exception as e:
             print(f"Failed to read SQL file: {e}")
             return []
@@ -361,48 +1013,94 @@ class TokenMigrator:
     
     def check_existing_tokens(self) -> set:
         """检查New API数据库中已存在的token keys"""
-        cursor = self.conn.cursor()
         try:
-            cursor.execute("SELECT key FROM tokens WHERE deleted_at IS NULL")
-            existing_keys = {row[0] for row in cursor.fetchall()}
+            existing_keys = self.backend.existing_token_keys()
             print(f"Found {len(existing_keys)} existing tokens in New API database")
             return existing_keys
         except Exception as e:
             print(f"Warning: Could not check existing tokens: {e}")
             return set()
-        finally:
-            cursor.close()
     
-    def insert_token(self, token: Dict) -> bool:
-        """插入单个token到New API数据库"""
-        cursor = self.conn.cursor()
+    def insert_batch(self, table: str, columns, records: List[Dict], label: str) -> List[Dict]:
+        """批量写入一批记录；整批失败时回滚到保存点并逐行重试，返回成功写入的记录"""
+        rows = [tuple(record[c] for c in columns) for record in records]
+        self.backend.savepoint('migrate_batch')
         try:
-            insert_sql = """
-                INSERT INTO tokens (
-                    user_id, key, status, name, created_time, accessed_time, 
-                    expired_time, remain_quota, unlimited_quota, model_limits_enabled,
-                    model_limits, allow_ips, used_quota, "group"
-                ) VALUES (
-                    %(user_id)s, %(key)s, %(status)s, %(name)s, %(created_time)s,
-                    %(accessed_time)s, %(expired_time)s, %(remain_quota)s, 
-                    %(unlimited_quota)s, %(model_limits_enabled)s, %(model_limits)s,
-                    %(allow_ips)s, %(used_quota)s, %(group)s
-                )
-            """
-            cursor.execute(insert_sql, token)
-            return True
+            self.backend.bulk_insert(table, columns, rows)
+            self.backend.release_savepoint('migrate_batch')
+            return records
         except Exception as e:
-            print(f"Error inserting token '{token.get('name', 'Unknown')}': {e}")
+            self.backend.rollback_to_savepoint('migrate_batch')
+            print(f"Bulk insert into {table} failed, retrying row by row: {e}")
+        
+        inserted = []
+        for record, row in zip(records, rows):
+            self.backend.savepoint('migrate_row')
+            try:
+                self.backend.insert_row(table, columns, row)
+                self.backend.release_savepoint('migrate_row')
+                inserted.append(record)
+            except Exception as e:
+                self.backend.rollback_to_savepoint('migrate_row')
+                print(f"Error inserting {table[:-1]} '{record.get(label) or 'Unknown'}': {e}")
+        return inserted
+    
+    def resolve_user_ids(self, user_sources: Dict[str, Any]):
+        """用户写入后按用户名查回New API分配的id，建立One API用户id到New API用户id的映射"""
+        if self.user_id_map is None:
+            self.user_id_map = {}
+        usernames = list(user_sources)
+        for i in range(0, len(usernames), 500):
+            for username, new_id in self.backend.fetch_user_ids(usernames[i:i + 500]).items():
+                self.user_id_map[user_sources[username]] = new_id
+    
+    def remap_token_owner(self, token: Dict) -> bool:
+        """把token的user_id改写为New API中的用户id；所属用户未迁移成功时返回False"""
+        if self.user_id_map is None:
+            return True
+        new_id = self.user_id_map.get(token['user_id'])
+        if new_id is None:
             return False
-        finally:
-            cursor.close()
+        token['user_id'] = new_id
+        return True
+    
+    def verify_token_owners(self) -> int:
+        """检查本次迁移的token的user_id是否都能在users表中找到，返回找不到的数量"""
+        orphans = 0
+        keys = self.migrated_token_keys
+        for i in range(0, len(keys), 500):
+            orphans += self.backend.count_orphan_tokens(keys[i:i + 500])
+        if orphans:
+            print(f"Warning: {orphans} migrated tokens reference a user_id that does not exist in {self.backend.describe()}")
+        return orphans
+    
+    def commit_stage(self):
+        """阶段结束时按后端策略提交；不逐批提交的后端（SQLite）由migrate_all最后统一提交"""
+        if self.backend.commit_per_batch:
+            self.backend.commit()
+    
+    def flush_records(self, kind: str, records: List[Dict], stats: Dict[str, int]):
+        """写入一批已转换的用户或token并按后端策略提交（SQLite整个迁移只用一个事务）"""
+        if kind == 'user':
+            inserted = self.insert_batch('users', USER_COLUMNS, records, 'username')
+        else:
+            inserted = self.insert_batch('tokens', TOKEN_COLUMNS, records, 'name')
+        if self.backend.commit_per_batch:
+            self.backend.commit()
+        
+        for record in inserted:
+            print(f"Migrated {kind}: {record['username'] if kind == 'user' else record['name']}")
+        if kind == 'token':
+            self.migrated_token_keys.extend(record['key'] for record in inserted)
+        stats['migrated'] += len(inserted)
+        stats['failed'] += len(records) - len(inserted)
     
     def read_from_sqlite(self, sqlite_file: str) -> List[Dict]:
         """从One API的SQLite文件中读取tokens数据"""
         print(f"Reading tokens from SQLite file: {sqlite_file}")
         
         try:
-            sqlite_conn = sqlite3.connect(sqlite_file)
+            sqlite_conn = sqlite3.connect(self.resolve_sqlite_source(sqlite_file))
             sqlite_conn.row_factory = sqlite3.Row  # 使用字典式访问
             cursor = sqlite_conn.cursor()
             
@@ -446,7 +1144,7 @@ class TokenMigrator:
         print(f"Reading users from SQLite file: {sqlite_file}")
         
         try:
-            sqlite_conn = sqlite3.connect(sqlite_file)
+            sqlite_conn = sqlite3.connect(self.resolve_sqlite_source(sqlite_file))
             sqlite_conn.row_factory = sqlite3.Row
             cursor = sqlite_conn.cursor()
             
@@ -517,142 +1215,213 @@ class TokenMigrator:
     
     def check_existing_users(self) -> set:
         """检查New API数据库中已存在的用户名"""
-        cursor = self.conn.cursor()
         try:
-            cursor.execute("SELECT username FROM users")
-            existing_usernames = {row[0] for row in cursor.fetchall()}
+            existing_usernames = self.backend.existing_usernames()
             print(f"Found {len(existing_usernames)} existing users in New API database")
             return existing_usernames
         except Exception as e:
             print(f"Warning: Could not check existing users: {e}")
             return set()
-        finally:
-            cursor.close()
-    
-    def insert_user(self, user: Dict) -> bool:
-        """插入单个用户到New API数据库"""
-        cursor = self.conn.cursor()
-        try:
-            insert_sql = """
-                INSERT INTO users (
-                    username, password, display_name, role, status, email,
-                    github_id, oidc_id, wechat_id, telegram_id, access_token,
-                    quota, used_quota, request_count, "group", aff_code, aff_count
-                ) VALUES (
-                    %(username)s, %(password)s, %(display_name)s, %(role)s, %(status)s,
-                    %(email)s, %(github_id)s, %(oidc_id)s, %(wechat_id)s, %(telegram_id)s,
-                    %(access_token)s, %(quota)s, %(used_quota)s, %(request_count)s,
-                    %(group)s, %(aff_code)s, %(aff_count)s
-                )
-            """
-            cursor.execute(insert_sql, user)
-            return True
-        except Exception as e:
-            print(f"Error inserting user '{user.get('username', 'Unknown')}': {e}")
-            return False
-        finally:
-            cursor.close()
 
     def migrate_users(self, source_file: str) -> Dict[str, int]:
         """迁移用户数据"""
         print("\n=== 开始迁移用户数据 ===")
         
+        # 迁移用户时token的user_id必须改写为New API分配的id；用户读取失败时token也不能沿用原id
+        self.user_id_map = {}
+        
         # 读取One API用户数据
-        one_api_users = self.read_users_from_sqlite(source_file)
+        with self.stage('read_users'):
+            one_api_users = self.read_users_from_sqlite(source_file)
         if not one_api_users:
             print("No users found in source database")
             return {'migrated': 0, 'skipped': 0, 'failed': 0}
         
-        # 检查已存在的用户
-        existing_usernames = self.check_existing_users()
+        with self.stage('write_users'):
+            # 检查已存在的用户
+            existing_usernames = self.check_existing_users()
         
-        # 开始迁移
-        migrated = 0
-        skipped = 0
-        failed = 0
+            # 开始迁移
+            stats = {'migrated': 0, 'skipped': 0, 'failed': 0}
+            pending = []
+            user_sources = {}
         
-        for user in one_api_users:
-            username = user.get('username')
-            
-            if not username:
-                print(f"Skipping user: No username found")
-                failed += 1
-                continue
-            
-            if username in existing_usernames:
-                print(f"Skipping existing user: {username}")
-                skipped += 1
-                continue
+            for user in one_api_users:
+                username = user.get('username')
             
-            # 转换格式
-            new_user = self.convert_user_to_new_api_format(user)
+                if not username:
+                    print(f"Skipping user: No username found")
+                    stats['failed'] += 1
+                    continue
             
-            # 插入数据库
-            if self.insert_user(new_user):
-                print(f"Migrated user: {username}")
-                migrated += 1
-            else:
-                failed += 1
+                # 已存在的同名用户也记录来源id，其token归属到该用户
+                user_sources[username] = user['id']
+                if username in existing_usernames:
+                    print(f"Skipping existing user: {username}")
+                    stats['skipped'] += 1
+                    continue
             
-            # 提交事务
-            self.conn.commit()
+                # 转换格式，攒够一批后批量写入
+                existing_usernames.add(username)
+                pending.append(self.convert_user_to_new_api_format(user))
+                if len(pending) >= self.batch_size:
+                    self.flush_records('user', pending, stats)
+                    pending = []
+        
+            if pending:
+                self.flush_records('user', pending, stats)
+            self.resolve_user_ids(user_sources)
+            self.commit_stage()
         
-        return {'migrated': migrated, 'skipped': skipped, 'failed': failed}
+        return stats
 
     def migrate_tokens_only(self, source_file: str, source_type: str = 'sql') -> Dict[str, int]:
         """迁移token数据（内部方法）"""
         print("\n=== 开始迁移Token数据 ===")
         
         # 根据源类型获取数据
-        if source_type == 'sqlite':
-            one_api_tokens = self.read_from_sqlite(source_file)
-        else:
-            one_api_tokens = self.parse_sql_file(source_file)
+        with self.stage('read_tokens'):
+            if source_type == 'sqlite':
+                one_api_tokens = self.read_from_sqlite(source_file)
+            else:
+                one_api_tokens = self.parse_sql_file(source_file)
         
         if not one_api_tokens:
             print(f"No tokens found in {source_type} file")
             return {'migrated': 0, 'skipped': 0, 'failed': 0}
         
-        # 检查已存在的tokens
-        existing_keys = self.check_existing_tokens()
+        with self.stage('write_tokens'):
+            # 检查已存在的tokens
+            existing_keys = self.check_existing_tokens()
         
-        # 开始迁移
-        migrated = 0
-        skipped = 0
-        failed = 0
+            # 开始迁移
+            stats = {'migrated': 0, 'skipped': 0, 'failed': 0}
+            pending = []
         
-        for token in one_api_tokens:
-            token_key = token.get('key')
-            token_name = token.get('name', 'Unknown')
-            
-            if not token_key:
-                print(f"Skipping token '{token_name}': No key found")
-                failed += 1
-                continue
+            for token in one_api_tokens:
+                token_key = token.get('key')
+                token_name = token.get('name', 'Unknown')
             
-            if token_key in existing_keys:
-                print(f"Skipping existing token: {token_name}")
-                skipped += 1
-                continue
+                if not token_key:
+                    print(f"Skipping token '{token_name}': No key found")
+                    stats['failed'] += 1
+                    continue
             
-            # 转换格式
-            new_token = self.convert_to_new_api_format(token)
+                if token_key in existing_keys:
+                    print(f"Skipping existing token: {token_name}")
+                    stats['skipped'] += 1
+                    continue
             
-            # 插入数据库
-            if self.insert_token(new_token):
-                print(f"Migrated token: {token_name}")
-                migrated += 1
-            else:
-                failed += 1
-            
-            # 提交事务
-            self.conn.commit()
+                # 转换格式，攒够一批后批量写入
+                new_token = self.convert_to_new_api_format(token)
+                if not self.remap_token_owner(new_token):
+                    print(f"Skipping token '{token_name}': owner user {token['user_id']} was not migrated")
+                    stats['failed'] += 1
+                    continue
+                existing_keys.add(token_key)
+                pending.append(new_token)
+                if len(pending) >= self.batch_size:
+                    self.flush_records('token', pending, stats)
+                    pending = []
+        
+            if pending:
+                self.flush_records('token', pending, stats)
+            self.commit_stage()
+            stats['orphans'] = self.verify_token_owners()
         
-        return {'migrated': migrated, 'skipped': skipped, 'failed': failed}
+        return stats
+
+    def token_cache_key(self, key: str, prefix: str = 'token') -> str:
+        """生成与New API一致的token缓存键: token:<HMAC-SHA256(key)>"""
+        digest = hmac.new(
+            self.cache_config['secret'].encode('utf-8'),
+            key.encode('utf-8'),
+            hashlib.sha256
+        ).hexdigest()
+        return f"{prefix}:{digest}"
+
+    def warm_token_cache(self, keys: List[str]) -> Dict[str, int]:
+        """将刚迁移的tokens批量写入New API的Redis缓存"""
+        print("\n=== 开始预热Redis Token缓存 ===")
+
+        stats = {'warmed': 0, 'existing': 0, 'fenced': 0, 'failed': 0}
+        if not keys:
+            print("No migrated tokens to warm up")
+            return stats
+
+        client = redis.Redis.from_url(self.cache_config['url'])
+        try:
+            try:
+                client.ping()
+            except Exception as e:
+                print(f"Failed to connect to Redis: {e}")
+                stats['failed'] = len(keys)
+                return stats
+
+            init_script = client.register_script(TOKEN_CACHE_INIT_SCRIPT)
+            ttl = self.cache_config['ttl']
+            batch_size = self.cache_config['batch_size']
+
+            def warm_batch(tokens: List[Dict]) -> List[Any]:
+                # 非事务pipeline：每批只需一次网络往返
+                pipe = client.pipeline(transaction=False)
+                for token in tokens:
+                    init_script(
+                        keys=[self.token_cache_key(token['key']), self.token_cache_key(token['key'], 'token:fence')],
+                        args=[
+                            token['id'], token['user_id'], token['status'], token['name'] or '',
+                            token['created_time'] or 0, token['accessed_time'] or 0, token['expired_time'],
+                            format_go_bool(token['unlimited_quota']), format_go_bool(token['model_limits_enabled']),
+                            token['model_limits'] or '', token['allow_ips'] or '', token['group'] or '',
+                            format_go_bool(False), '',
+                            token['remain_quota'], token['used_quota'],
+                            ttl,
+                        ],
+                        client=pipe,
+                    )
+                return pipe.execute(raise_on_error=False)
+
+            with ThreadPoolExecutor(max_workers=self.cache_config['concurrency']) as executor:
+                futures = []
+                for i in range(0, len(keys), batch_size):
+                    batch_keys = keys[i:i + batch_size]
+                    # 预热失败不影响已提交的迁移结果，只计入失败
+                    try:
+                        tokens = self.backend.fetch_tokens(batch_keys)
+                        if tokens:
+                            futures.append((executor.submit(warm_batch, tokens), len(tokens)))
+                    except Exception as e:
+                        print(f"Error reading tokens for cache warm-up: {e}")
+                        stats['failed'] += len(batch_keys)
+                        continue
+                    stats['failed'] += len(batch_keys) - len(tokens)
+
+                for future, batch_len in futures:
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        print(f"Error warming token cache batch: {e}")
+                        stats['failed'] += batch_len
+                        continue
+                    for result in results:
+                        if isinstance(result, Exception):
+                            stats['failed'] += 1
+                        elif result == 1:
+                            stats['warmed'] += 1
+                        elif result == 2:
+                            stats['existing'] += 1
+                        else:
+                            stats['fenced'] += 1
+        finally:
+            client.close()
+        return stats
 
     def migrate_all(self, source_file: str, source_type: str = 'sql', create_backup: bool = True, 
-                   backup_path: Optional[str] = None, migrate_users: bool = True, migrate_tokens: bool = True):
+                   backup_path: Optional[str] = None, migrate_users: bool = True, migrate_tokens: bool = True,
+                   warm_cache: bool = False, profile: bool = False, profile_top: int = 20):
         """执行完整迁移"""
+        if profile:
+            self.profiler = StageProfiler(profile_output_dir(backup_path), profile_top)
         self.connect_db()
         
         try:
@@ -660,7 +1429,8 @@ class TokenMigrator:
             backup_file = None
             if create_backup:
                 print("Creating database backup before migration...")
-                backup_file = self.backup_database(backup_path)
+                with self.stage('backup'):
+                    backup_file = self.backup_database(backup_path)
                 if backup_file:
                     print(f"Backup created: {backup_file}")
                 else:
@@ -679,6 +1449,15 @@ class TokenMigrator:
             if migrate_tokens:
                 token_stats = self.migrate_tokens_only(source_file, source_type)
             
+            # 用户和token的写入在此一次提交（SQLite整个迁移只有这一个事务）
+            self.backend.commit()
+            
+            # 预热Redis缓存
+            cache_stats = None
+            if warm_cache and migrate_tokens:
+                with self.stage('warm_cache'):
+                    cache_stats = self.warm_token_cache(self.migrated_token_keys)
+            
             # 打印汇总统计信息
             print(f"\n=== 迁移完成汇总 ===")
             if migrate_users:
@@ -692,44 +1471,330 @@ class TokenMigrator:
                 print(f"- 迁移: {token_stats['migrated']} 个tokens")
                 print(f"- 跳过: {token_stats['skipped']} 个tokens (已存在)")
                 print(f"- 失败: {token_stats['failed']} 个tokens")
+                if token_stats.get('orphans'):
+                    print(f"- 警告: {token_stats['orphans']} 个tokens的user_id在users表中不存在")
+            
+            if cache_stats:
+                print(f"Redis缓存预热:")
+                print(f"- 写入: {cache_stats['warmed']} 个tokens")
+                print(f"- 跳过: {cache_stats['existing']} 个tokens (缓存已存在)")
+                print(f"- 拦截: {cache_stats['fenced']} 个tokens (存在fence)")
+                print(f"- 失败: {cache_stats['failed']} 个tokens")
             
             total_migrated = user_stats['migrated'] + token_stats['migrated']
             if backup_file and total_migrated > 0:
                 print(f"\n数据库备份文件: {backup_file}")
-                print("恢复命令: psql -h host -U user -d database -f backup_file.sql")
+                print(f"恢复命令: {self.backend.restore_hint(backup_file)}")
             
         except Exception as e:
             print(f"Migration failed: {e}")
-            if self.conn:
-                self.conn.rollback()
+            if self.backend.conn:
+                self.backend.rollback()
         finally:
             self.close_db()
+            self.cleanup_sources()
+            if self.profiler:
+                self.profiler.write_report()
+
+
+class ShardedTokenMigrator:
+    """一次读取One API数据，按用户分区并发写入多个New API数据库"""
+
+    def __init__(self, db_configs: List[Dict[str, Any]], shard_map: Optional[Dict[str, int]] = None,
+                 cache_config: Optional[Dict[str, Any]] = None, batch_size: int = 1000):
+        self.shards = [TokenMigrator(db_config, cache_config, batch_size) for db_config in db_configs]
+        self.shard_map = shard_map or {}
+        self.batch_size = batch_size
+
+    def shard_for_user(self, user_id: Any) -> int:
+        """显式映射优先，否则按user_id的CRC32取模"""
+        mapped = self.shard_map.get(str(user_id))
+        if mapped is not None:
+            return mapped
+        return zlib.crc32(str(user_id).encode('utf-8')) % len(self.shards)
+
+    def shard_backup_path(self, index: int, backup_path: Optional[str], timestamp: str) -> str:
+        """为每个分片生成独立的备份文件名"""
+        if backup_path:
+            root, ext = os.path.splitext(backup_path)
+            return f"{root}_shard{index}{ext or self.shards[index].backend.backup_suffix}"
+        return f"newapi_backup_{timestamp}_shard{index}{self.shards[index].backend.backup_suffix}"
+
+    def write_shard(self, index: int, work_queue: queue.Queue, migrate_users: bool,
+                    warm_cache: bool) -> Dict[str, Dict[str, int]]:
+        """分片写入线程：消费队列，攒批后走后端的批量写入"""
+        migrator = self.shards[index]
+        stats = {
+            'user': {'migrated': 0, 'skipped': 0, 'failed': 0},
+            'token': {'migrated': 0, 'skipped': 0, 'failed': 0},
+        }
+        existing = {'user': None, 'token': None}
+        pending = {'user': [], 'token': []}
+        user_sources = {}
+        # 迁移用户时，token的user_id必须改写为本分片中分配的用户id
+        users_resolved = not migrate_users
+        if migrate_users:
+            migrator.user_id_map = {}
+        broken = False
+
+        def flush(kind: str):
+            if pending[kind]:
+                migrator.flush_records(kind, pending[kind], stats[kind])
+                pending[kind] = []
+
+        with migrator.stage(f'shard{index}_write', profile=PER_THREAD_PROFILING, memory=False):
+            while True:
+                item = work_queue.get()
+                if item is None:
+                    break
+                kind, record = item
+
+                # 写入已出错时继续消费队列，避免读取端阻塞
+                if broken:
+                    stats[kind]['failed'] += 1
+                    continue
+
+                try:
+                    if existing[kind] is None:
+                        existing[kind] = (migrator.check_existing_users() if kind == 'user'
+                                          else migrator.check_existing_tokens())
+                    if kind == 'user':
+                        source_id, record = record
+                        ident = record.get('username')
+                        if not ident:
+                            print(f"[shard {index}] Skipping user: No username found")
+                            stats[kind]['failed'] += 1
+                            continue
+                        user_sources[ident] = source_id
+                    else:
+                        ident = record.get('key')
+                        if not ident:
+                            print(f"[shard {index}] Skipping token '{record.get('name', 'Unknown')}': No key found")
+                            stats[kind]['failed'] += 1
+                            continue
+                    if ident in existing[kind]:
+                        print(f"[shard {index}] Skipping existing {kind}: {record.get('username') or record.get('name')}")
+                        stats[kind]['skipped'] += 1
+                        continue
+
+                    if kind == 'token':
+                        # 用户全部先于token入队，切换到token前先写完剩余用户并查回其新id
+                        if not users_resolved:
+                            flush('user')
+                            migrator.resolve_user_ids(user_sources)
+                            users_resolved = True
+                        if not migrator.remap_token_owner(record):
+                            print(f"[shard {index}] Skipping token '{record.get('name', 'Unknown')}': "
+                                  f"owner user {record['user_id']} was not migrated")
+                            stats[kind]['failed'] += 1
+                            continue
+
+                    existing[kind].add(ident)
+                    pending[kind].append(record)
+                    if len(pending[kind]) >= migrator.batch_size:
+                        flush(kind)
+                except Exception as e:
+                    print(f"[shard {index}] Write failed: {e}")
+                    broken = True
+
+            if not broken:
+                try:
+                    flush('user')
+                    flush('token')
+                    migrator.backend.commit()
+                except Exception as e:
+                    print(f"[shard {index}] Write failed: {e}")
+                    broken = True
+
+        if broken:
+            migrator.backend.rollback()
+            # 未提交的数据已回滚，计入失败；逐批提交的后端只有出错的那一批未计入
+            for kind_stats, kind in ((stats['user'], 'user'), (stats['token'], 'token')):
+                kind_stats['failed'] += len(pending[kind])
+                if not migrator.backend.commit_per_batch:
+                    kind_stats['failed'] += kind_stats['migrated']
+                    kind_stats['migrated'] = 0
+            if not migrator.backend.commit_per_batch:
+                migrator.migrated_token_keys = []
+
+        if not broken and migrator.migrated_token_keys:
+            stats['token']['orphans'] = migrator.verify_token_owners()
+
+        cache_stats = None
+        if warm_cache and not broken:
+            with migrator.stage(f'shard{index}_warm_cache', profile=PER_THREAD_PROFILING, memory=False):
+                cache_stats = migrator.warm_token_cache(migrator.migrated_token_keys)
+
+        return {'users': stats['user'], 'tokens': stats['token'], 'cache': cache_stats}
+
+    def migrate_all(self, source_file: str, source_type: str = 'sql', create_backup: bool = True,
+                    backup_path: Optional[str] = None, migrate_users: bool = True, migrate_tokens: bool = True,
+                    warm_cache: bool = False, profile: bool = False, profile_top: int = 20):
+        """执行分片迁移：一次读取，按分片并发写入"""
+        profiler = None
+        if profile:
+            profiler = StageProfiler(profile_output_dir(backup_path), profile_top)
+        for migrator in self.shards:
+            migrator.profiler = profiler
+            migrator.connect_db()
+
+        reader = self.shards[0]
+        try:
+            # 并发备份所有分片
+            if create_backup:
+                print("Creating database backups before migration...")
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                with reader.stage('backup'), ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+                    backup_files = list(executor.map(
+                        lambda i: self.shards[i].backup_database(self.shard_backup_path(i, backup_path, timestamp)),
+                        range(len(self.shards))
+                    ))
+                if not all(backup_files):
+                    response = input("Backup failed for at least one shard. Continue migration? (y/N): ")
+                    if response.lower() != 'y':
+                        print("Migration aborted.")
+                        return
+
+            queues = [queue.Queue(maxsize=self.batch_size * 4) for _ in self.shards]
+
+            # 读取、路由与各分片写入同时进行，内存只在合并的'shards'窗口中测量。
+            # Python 3.12+只能有一个profiler，cProfile也放在该窗口（覆盖所有线程），子阶段只记录耗时；
+            # 更早版本cProfile按线程生效，改为在读取/路由和每个分片写入线程上分别采集
+            with reader.stage('shards', profile=not PER_THREAD_PROFILING), \
+                    ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+                futures = [
+                    executor.submit(self.write_shard, i, queues[i], migrate_users, warm_cache)
+                    for i in range(len(self.shards))
+                ]
+
+                try:
+                    # 先路由用户再路由token，保证每个分片内用户先于其token写入
+                    if migrate_users:
+                        print("\n=== 开始迁移用户数据 ===")
+                        with reader.stage('read_users', profile=PER_THREAD_PROFILING, memory=False):
+                            one_api_users = reader.read_users_from_sqlite(source_file)
+                        with reader.stage('route_users', profile=PER_THREAD_PROFILING, memory=False):
+                            for user in one_api_users:
+                                queues[self.shard_for_user(user['id'])].put(
+                                    ('user', (user['id'], reader.convert_user_to_new_api_format(user))))
+
+                    if migrate_tokens:
+                        print("\n=== 开始迁移Token数据 ===")
+                        with reader.stage('read_tokens', profile=PER_THREAD_PROFILING, memory=False):
+                            if source_type == 'sqlite':
+                                one_api_tokens = reader.read_from_sqlite(source_file)
+                            else:
+                                one_api_tokens = reader.parse_sql_file(source_file)
+                        with reader.stage('route_tokens', profile=PER_THREAD_PROFILING, memory=False):
+                            for token in one_api_tokens:
+                                queues[self.shard_for_user(token['user_id'])].put(
+                                    ('token', reader.convert_to_new_api_format(token)))
+                finally:
+                    for work_queue in queues:
+                        work_queue.put(None)
+
+                results = [future.result() for future in futures]
+
+            # 打印汇总统计信息
+            print(f"\n=== 分片迁移完成汇总 ===")
+            for i, result in enumerate(results):
+                print(f"分片 {i} ({self.shards[i].backend.describe()}):")
+                if migrate_users:
+                    user_stats = result['users']
+                    print(f"- 用户: 迁移 {user_stats['migrated']}, 跳过 {user_stats['skipped']}, 失败 {user_stats['failed']}")
+                if migrate_tokens:
+                    token_stats = result['tokens']
+                    print(f"- Token: 迁移 {token_stats['migrated']}, 跳过 {token_stats['skipped']}, 失败 {token_stats['failed']}")
+                    if token_stats.get('orphans'):
+                        print(f"- 警告: {token_stats['orphans']} 个tokens的user_id在users表中不存在")
+                if result['cache']:
+                    cache_stats = result['cache']
+                    print(f"- 缓存预热: 写入 {cache_stats['warmed']}, 跳过 {cache_stats['existing']}, "
+                          f"拦截 {cache_stats['fenced']}, 失败 {cache_stats['failed']}")
+
+        except Exception as e:
+            print(f"Migration failed: {e}")
+            for migrator in self.shards:
+                if migrator.backend.conn:
+                    migrator.backend.rollback()
+        finally:
+            for migrator in self.shards:
+                migrator.close_db()
+            reader.cleanup_sources()
+            if profiler:
+                profiler.write_report()
+
+
+def profile_output_dir(backup_path: Optional[str]) -> str:
+    """性能报告写在备份文件所在目录（默认备份文件写在当前目录）"""
+    if backup_path:
+        return os.path.dirname(os.path.abspath(backup_path))
+    return os.getcwd()
+
+
+def parse_shard_target(spec: str, db_type: str = 'postgres') -> Optional[Dict[str, Any]]:
+    """解析分片目标 HOST[:PORT]/DBNAME；SQLite目标直接是文件路径"""
+    if db_type == 'sqlite':
+        return {'host': '', 'port': None, 'database': spec}
+    match = re.fullmatch(r'([^:/]+)(?::(\d+))?/(.+)', spec)
+    if not match:
+        return None
+    host, port, database = match.groups()
+    return {'host': host, 'port': int(port) if port else DEFAULT_DB_PORTS[db_type], 'database': database}
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Migrate users and tokens from One API to New API PostgreSQL')
+    parser = argparse.ArgumentParser(description='Migrate users and tokens from One API to New API (PostgreSQL, MySQL or SQLite)')
     
     # Source file options (mutually exclusive)
     source_group = parser.add_mutually_exclusive_group(required=True)
-    source_group.add_argument('--sqlite-file', help='Path to One API SQLite database file')
-    source_group.add_argument('--sql-file', help='Path to One API SQL export file (tokens only)')
+    source_group.add_argument('--sqlite-file',
+                              help='Path to One API SQLite database file (may be .gz/.zst/.bz2/.xz or inside a tarball)')
+    source_group.add_argument('--sql-file',
+                              help='Path to One API SQL export file, tokens only (may be .gz/.zst/.bz2/.xz or inside a tarball)')
     
     # Migration options (mutually exclusive)
     migration_group = parser.add_mutually_exclusive_group()
     migration_group.add_argument('--users-only', action='store_true', help='Migrate only users (SQLite only)')
     migration_group.add_argument('--tokens-only', action='store_true', help='Migrate only tokens')
     
-    # PostgreSQL connection options
-    parser.add_argument('--db-host', default='localhost', help='PostgreSQL host')
-    parser.add_argument('--db-port', default=5432, type=int, help='PostgreSQL port')
-    parser.add_argument('--db-name', required=True, help='PostgreSQL database name')
-    parser.add_argument('--db-user', required=True, help='PostgreSQL username')
-    parser.add_argument('--db-password', required=True, help='PostgreSQL password')
+    # New API database connection options
+    parser.add_argument('--db-type', default='postgres', choices=sorted(TARGET_BACKENDS), help='New API database type')
+    parser.add_argument('--db-host', default='localhost', help='Database host')
+    parser.add_argument('--db-port', type=int, help='Database port (default: 5432 for postgres, 3306 for mysql)')
+    parser.add_argument('--db-name', help='Database name, or file path for sqlite (required unless --shard is used)')
+    parser.add_argument('--db-user', help='Database username (not used for sqlite)')
+    parser.add_argument('--db-password', help='Database password (not used for sqlite)')
+    parser.add_argument('--batch-size', default=1000, type=int, help='Rows per bulk insert batch')
+    parser.add_argument('--mysql-load-data', action='store_true',
+                        help='Load MySQL batches with LOAD DATA LOCAL INFILE (requires local_infile on the server)')
+    
+    # Sharded target options
+    parser.add_argument('--shard', action='append', metavar='HOST[:PORT]/DBNAME',
+                        help='New API shard target (file path for sqlite); repeat for each shard '
+                             '(replaces --db-host/--db-port/--db-name)')
+    parser.add_argument('--shard-map', help='JSON file mapping One API user_id to shard index (default: CRC32 hash of user_id)')
     
     # Backup options
     parser.add_argument('--no-backup', action='store_true', help='Skip database backup before migration')
     parser.add_argument('--backup-path', help='Custom backup file path')
     
+    # Redis cache warm-up options
+    parser.add_argument('--warm-cache', action='store_true', help='Write migrated tokens into New API Redis token cache')
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_CONN_STRING'),
+                        help='Redis connection string used by New API (default: $REDIS_CONN_STRING)')
+    parser.add_argument('--crypto-secret', default=os.environ.get('CRYPTO_SECRET') or os.environ.get('SESSION_SECRET'),
+                        help='New API CRYPTO_SECRET used for cache key HMAC (default: $CRYPTO_SECRET, then $SESSION_SECRET)')
+    parser.add_argument('--cache-ttl', default=int(os.environ.get('SYNC_FREQUENCY') or 60), type=int,
+                        help='Token cache TTL in seconds (default: $SYNC_FREQUENCY or 60)')
+    parser.add_argument('--cache-batch-size', default=1000, type=int, help='Tokens per Redis pipeline batch')
+    parser.add_argument('--cache-concurrency', default=4, type=int, help='Concurrent Redis pipelines')
+    
+    # Profiling options
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile each migration stage (cProfile + tracemalloc); reports are written next to the backup file')
+    parser.add_argument('--profile-top', default=20, type=int, help='Number of functions/allocations listed per stage')
+    
     args = parser.parse_args()
     
     # 验证参数组合
@@ -737,15 +1802,86 @@ def main():
         print("Error: --users-only can only be used with --sqlite-file")
         sys.exit(1)
     
+    if not args.db_name and not args.shard:
+        print("Error: either --db-name or --shard is required")
+        sys.exit(1)
+    
+    if args.db_type != 'sqlite' and (args.db_user is None or args.db_password is None):
+        print(f"Error: --db-user and --db-password are required for {args.db_type}")
+        sys.exit(1)
+    
+    if args.mysql_load_data and args.db_type != 'mysql':
+        print("Error: --mysql-load-data can only be used with --db-type mysql")
+        sys.exit(1)
+    
+    if args.shard_map and not args.shard:
+        print("Error: --shard-map can only be used with --shard")
+        sys.exit(1)
+    
+    shard_map = None
+    if args.shard_map:
+        try:
+            with open(args.shard_map, 'r', encoding='utf-8') as f:
+                shard_map = {str(user_id): int(index) for user_id, index in json.load(f).items()}
+        except Exception as e:
+            print(f"Failed to read shard map: {e}")
+            sys.exit(1)
+        invalid = {index for index in shard_map.values() if not 0 <= index < len(args.shard)}
+        if invalid:
+            print(f"Error: shard map references unknown shard index: {sorted(invalid)}")
+            sys.exit(1)
+    
+    if args.batch_size <= 0:
+        print("Error: --batch-size must be positive")
+        sys.exit(1)
+    
+    if args.profile_top <= 0:
+        print("Error: --profile-top must be positive")
+        sys.exit(1)
+    
+    cache_config = None
+    if args.warm_cache:
+        if args.users_only:
+            print("Error: --warm-cache cannot be used with --users-only")
+            sys.exit(1)
+        if redis is None:
+            print("Please install required packages: pip install redis")
+            sys.exit(1)
+        if not args.redis_url or not args.crypto_secret:
+            print("Error: --warm-cache requires --redis-url and --crypto-secret")
+            sys.exit(1)
+        if args.cache_ttl <= 0 or args.cache_batch_size <= 0 or args.cache_concurrency <= 0:
+            print("Error: --cache-ttl, --cache-batch-size and --cache-concurrency must be positive")
+            sys.exit(1)
+        cache_config = {
+            'url': args.redis_url,
+            'secret': args.crypto_secret,
+            'ttl': args.cache_ttl,
+            'batch_size': args.cache_batch_size,
+            'concurrency': args.cache_concurrency
+        }
+    
     db_config = {
+        'type': args.db_type,
         'host': args.db_host,
-        'port': args.db_port,
+        'port': args.db_port or DEFAULT_DB_PORTS.get(args.db_type),
         'database': args.db_name,
         'user': args.db_user,
-        'password': args.db_password
+        'password': args.db_password,
+        'mysql_load_data': args.mysql_load_data
     }
     
-    migrator = TokenMigrator(db_config)
+    if args.shard:
+        db_configs = []
+        for spec in args.shard:
+            shard = parse_shard_target(spec, args.db_type)
+            if shard is None:
+                print(f"Error: invalid shard target '{spec}', expected HOST[:PORT]/DBNAME")
+                sys.exit(1)
+            db_configs.append(dict(db_config, **shard))
+        migrator = ShardedTokenMigrator(db_configs, shard_map, cache_config, args.batch_size)
+    else:
+        migrator = TokenMigrator(db_config, cache_config, args.batch_size)
     
     # 执行迁移
     create_backup = not args.no_backup
@@ -758,7 +1894,8 @@ def main():
         migrate_users = not args.tokens_only
         migrate_tokens = not args.users_only
         
-        migrator.migrate_all(source_file, source_type, create_backup, args.backup_path, migrate_users, migrate_tokens)
+        migrator.migrate_all(source_file, source_type, create_backup, args.backup_path, migrate_users, migrate_tokens,
+                             args.warm_cache, args.profile, args.profile_top)
     
     else:  # SQL file
         source_type = 'sql'
@@ -768,7 +1905,8 @@ def main():
         migrate_users = False
         migrate_tokens = True
         
-        migrator.migrate_all(source_file, source_type, create_backup, args.backup_path, migrate_users, migrate_tokens)
+        migrator.migrate_all(source_file, source_type, create_backup, args.backup_path, migrate_users, migrate_tokens,
+                             args.warm_cache, args.profile, args.profile_top)
 
 
 if __name__ == '__main__':